@@ -4,17 +4,24 @@ Main application entry point
 """
 import os
 import sys
+import atexit
 import threading
 import time
 import json
+import locale
 import logging
+import platform
+import shutil
+import subprocess
 from pathlib import Path
 from mitm_proxy import MITMProxyServer
 
-# Configure logging
+# Configure logging; force=True because importing mitm_proxy already configured the root logger
 logging.basicConfig(
     level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    datefmt='%H:%M:%S',
+    force=True
 )
 logger = logging.getLogger(__name__)
 
@@ -25,70 +32,183 @@ except ImportError:
     WEBVIEW_AVAILABLE = False
     logger.warning("pywebview not available, will run proxy only")
 
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
+
+_APP_DIR = Path(__file__).resolve().parent
+_CERT_DIR = _APP_DIR / '.certs'
+_CA_CERT_PATH = _CERT_DIR / 'ca-cert.pem'
+_SYSTEM = platform.system()
+
+# Trust-store import commands; the certificate path is appended per call
+_CERTUTIL_ARGS = ('certutil', '-addstore', '-f', 'ROOT')
+_SECURITY_ARGS = ('sudo', 'security', 'add-trusted-cert', '-d', '-r', 'trustRoot',
+                  '-k', '/Library/Keychains/System.keychain')
+_UPDATE_CA_ARGS = ('sudo', 'update-ca-certificates')
+
+# Shown when static/index.html is missing
+_FALLBACK_HTML = """<!DOCTYPE html>
+<html>
+<head>
+    <title>代理管理系统</title>
+    <style>
+        body { font-family: Arial; padding: 20px; background: #f5f5f5; }
+        .container { max-width: 1000px; margin: 0 auto; background: white; padding: 20px; border-radius: 10px; }
+        h1 { color: #667eea; }
+        button { background: #667eea; color: white; padding: 10px 20px; border: none; border-radius: 5px; cursor: pointer; }
+        input { padding: 8px; border: 1px solid #ddd; border-radius: 5px; }
+    </style>
+</head>
+<body>
+    <div class="container">
+        <h1>HTTP/HTTPS 代理管理系统</h1>
+        <p>代理管理系统已启动，正在加载界面...</p>
+    </div>
+</body>
+</html>
+""".encode('utf-8')
+
+
+def _decode_output(data: bytes) -> str:
+    """Decode subprocess output the same way text=True would"""
+    return data.decode(locale.getpreferredencoding(False), 'replace')
+
 
 class AppAPI:
     """API for the frontend to communicate with the proxy server"""
 
-    def __init__(self, config_path: str, proxy_config: dict):
+    def __init__(self, config_path: str, proxy_config: dict, on_config_change=None):
         self.config_path = config_path
         self.proxy_config = proxy_config
+        # Called with the new config after rule edits so the running proxy picks them up
+        self._on_config_change = on_config_change
+        # Parsed config.json and the st_mtime_ns it was read at
+        self._cfg_cache = None
+        self._cfg_mtime = 0
+        # Pooled HTTP session for test_url, created on first use
+        self._http_session = None
+        # Rule edits are coalesced and written once the UI goes idle
+        self._dirty = False
+        self._flush_timer = None
+        self._flush_lock = threading.Lock()
+        atexit.register(self._flush)
+        # (scanned_at, {name: DirEntry}) for the certificate directory, polled by the UI
+        self._cert_scan = (float('-inf'), {})
         logger.info("AppAPI initialized")
 
     def _load_config(self) -> dict:
         """Load configuration from JSON file"""
+        if self._dirty:
+            # Unsaved edits in memory are newer than the file
+            return self.proxy_config
         try:
-            with open(self.config_path, 'r', encoding='utf-8') as f:
-                config = json.load(f)
+            st = os.stat(self.config_path)
+            if st.st_mtime_ns == self._cfg_mtime and self._cfg_cache is not None:
+                return self._cfg_cache
+            if ORJSON_AVAILABLE:
+                config = orjson.loads(Path(self.config_path).read_bytes())
+            else:
+                with open(self.config_path, 'r', encoding='utf-8') as f:
+                    config = json.load(f)
             self.proxy_config = config
+            self._cfg_cache = config
+            self._cfg_mtime = st.st_mtime_ns
             return config
         except Exception as e:
-            logger.error(f"Failed to load config: {e}")
+            logger.error("Failed to load config: %s", e)
             return self.proxy_config
 
     def _save_config(self, config: dict) -> bool:
         """Save configuration to JSON file"""
         try:
-            with open(self.config_path, 'w', encoding='utf-8') as f:
-                json.dump(config, f, indent=2, ensure_ascii=False)
+            if ORJSON_AVAILABLE:
+                data = orjson.dumps(config, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS)
+            else:
+                data = json.dumps(config, indent=2, ensure_ascii=False).encode('utf-8')
+            # Write a sibling temp file and swap it in, so a crash never leaves a truncated config
+            tmp_path = self.config_path + '.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, self.config_path)
             self.proxy_config = config
+            self._cfg_cache = config
+            self._cfg_mtime = os.stat(self.config_path).st_mtime_ns
             return True
         except Exception as e:
-            logger.error(f"Failed to save config: {e}")
+            logger.error("Failed to save config: %s", e)
             return False
 
+    def _schedule_flush(self):
+        """Mark config dirty and save it after 50ms without further edits"""
+        with self._flush_lock:
+            self._dirty = True
+            if self._flush_timer is not None:
+                self._flush_timer.cancel()
+            self._flush_timer = threading.Timer(0.05, self._flush)
+            self._flush_timer.daemon = True
+            self._flush_timer.start()
+
+    def _flush(self) -> bool:
+        """Write pending config changes to disk"""
+        with self._flush_lock:
+            if self._flush_timer is not None:
+                self._flush_timer.cancel()
+                self._flush_timer = None
+            if not self._dirty:
+                return True
+            if not self._save_config(self.proxy_config):
+                return False
+            self._dirty = False
+            return True
+
+    def flush_now(self):
+        """Save pending configuration changes immediately"""
+        return self._flush()
+
     def get_config(self):
         """Get current configuration"""
         return self._load_config()
 
+    def _scan_certs(self) -> dict:
+        """List the certificate directory once, cached for 2 seconds"""
+        scanned_at, entries = self._cert_scan
+        now = time.monotonic()
+        if now - scanned_at > 2.0:
+            try:
+                with os.scandir(_CERT_DIR) as it:
+                    entries = {entry.name: entry for entry in it}
+            except FileNotFoundError:
+                entries = {}
+            self._cert_scan = (now, entries)
+        return entries
+
     def get_https_status(self):
         """Get HTTPS certificate status"""
-        ca_cert_path = Path(__file__).parent / '.certs' / 'ca-cert.pem'
         return {
             "enabled": True,
-            "ca_cert_exists": ca_cert_path.exists(),
-            "ca_cert_path": str(ca_cert_path),
+            "ca_cert_exists": _CA_CERT_PATH.name in self._scan_certs(),
+            "ca_cert_path": str(_CA_CERT_PATH),
             "mode": "MITM"
         }
 
     def import_ca_cert(self):
         """Import CA certificate to system trust store"""
-        import subprocess
-        import os
-        import platform
-        
-        ca_cert_path = Path(__file__).parent / '.certs' / 'ca-cert.pem'
+        ca_cert_path = _CA_CERT_PATH
         if not ca_cert_path.exists():
             return {"status": "error", "message": "CA证书文件不存在"}
         
-        system = platform.system()
+        system = _SYSTEM
         
         try:
             if system == "Windows":
                 # Windows: 使用certutil导入到受信任的根证书颁发机构
                 result = subprocess.run(
-                    ['certutil', '-addstore', '-f', 'ROOT', str(ca_cert_path)],
+                    _CERTUTIL_ARGS + (str(ca_cert_path),),
                     capture_output=True,
-                    text=True
+                    check=False
                 )
                 if result.returncode == 0:
                     return {
@@ -96,14 +216,14 @@ class AppAPI:
                         "message": "CA证书已成功导入到系统受信任根证书颁发机构"
                     }
                 else:
-                    return {"status": "error", "message": f"导入失败: {result.stderr}"}
+                    return {"status": "error", "message": f"导入失败: {_decode_output(result.stderr)}"}
             
             elif system == "Darwin":  # macOS
                 # macOS: 导入到系统钥匙串
                 result = subprocess.run(
-                    ['sudo', 'security', 'add-trusted-cert', '-d', '-r', 'trustRoot', '-k', '/Library/Keychains/System.keychain', str(ca_cert_path)],
+                    _SECURITY_ARGS + (str(ca_cert_path),),
                     capture_output=True,
-                    text=True
+                    check=False
                 )
                 if result.returncode == 0:
                     return {
@@ -111,7 +231,7 @@ class AppAPI:
                         "message": "CA证书已成功导入到系统钥匙串"
                     }
                 else:
-                    return {"status": "error", "message": f"导入失败: {result.stderr}"}
+                    return {"status": "error", "message": f"导入失败: {_decode_output(result.stderr)}"}
             
             elif system == "Linux":
                 # Linux: 导入到系统证书目录
@@ -121,19 +241,18 @@ class AppAPI:
                 
                 if cert_dir.exists():
                     # 复制证书到系统目录
-                    import shutil
                     target_path = cert_dir / 'aiproxy-ca.crt'
                     shutil.copy2(str(ca_cert_path), str(target_path))
                     
                     # 更新证书存储
-                    result = subprocess.run(['sudo', 'update-ca-certificates'], capture_output=True, text=True)
+                    result = subprocess.run(_UPDATE_CA_ARGS, capture_output=True, check=False)
                     if result.returncode == 0:
                         return {
                             "status": "success",
                             "message": "CA证书已成功导入到系统证书存储"
                         }
                     else:
-                        return {"status": "error", "message": f"更新证书失败: {result.stderr}"}
+                        return {"status": "error", "message": f"更新证书失败: {_decode_output(result.stderr)}"}
                 else:
                     return {"status": "error", "message": "未找到系统证书目录，请手动导入"}
             
@@ -147,110 +266,106 @@ class AppAPI:
 
     def update_config(self, config):
         """Update configuration"""
-        return self._save_config(config)
+        with self._flush_lock:
+            self.proxy_config = config
+            self._dirty = True
+            self._notify_config_change()
+        return self.flush_now()
 
     def add_rule(self, source, target):
         """Add a proxy rule"""
         if not source or not target:
-            logger.warning(f"Invalid rule - source: {source}, target: {target}")
+            logger.warning("Invalid rule - source: %s, target: %s", source, target)
             return {"status": "error", "message": "Missing source or target"}
 
-        self.proxy_config['proxy_rules'][source] = target
-        if self._save_config(self.proxy_config):
-            logger.info(f"Rule added: {source} -> {target}")
-            return {"status": "success", "rule": {source: target}}
-        logger.error(f"Failed to save config")
-        return {"status": "error", "message": "Failed to save config"}
+        with self._flush_lock:
+            self.proxy_config['proxy_rules'][source] = target
+            self._notify_config_change()
+        self._schedule_flush()
+        logger.info("Rule added: %s -> %s", source, target)
+        return {"status": "success", "rule": {source: target}}
 
     def delete_rule(self, source):
         """Delete a proxy rule"""
-        if source in self.proxy_config.get('proxy_rules', {}):
-            del self.proxy_config['proxy_rules'][source]
-            if self._save_config(self.proxy_config):
-                logger.info(f"Rule deleted: {source}")
-                return {"status": "success"}
-        logger.warning(f"Rule not found: {source}")
+        with self._flush_lock:
+            found = self.proxy_config.get('proxy_rules', {}).pop(source, None) is not None
+            if found:
+                self._notify_config_change()
+        if found:
+            self._schedule_flush()
+            logger.info("Rule deleted: %s", source)
+            return {"status": "success"}
+        logger.warning("Rule not found: %s", source)
         return {"status": "error", "message": "Rule not found"}
 
+    def _notify_config_change(self):
+        """Hand the current config to the proxy, if one is attached; call with _flush_lock held"""
+        if self._on_config_change is not None:
+            self._on_config_change(self.proxy_config)
+
     def get_rules(self):
         """Get all proxy rules"""
         return self.proxy_config.get('proxy_rules', {})
 
+    def _get_http_session(self):
+        """Get the shared HTTP session, keeping connections alive across tests"""
+        if self._http_session is None:
+            import requests
+            self._http_session = requests.Session()
+            atexit.register(self._http_session.close)
+        return self._http_session
+
     def test_url(self, url):
         """Test a URL"""
         try:
-            import requests
-            resp = requests.get(url, timeout=10, verify=False)
-            logger.info(f"Test request successful: {url} - {resp.status_code}")
+            resp = self._get_http_session().get(url, timeout=10, verify=False)
+            logger.info("Test request successful: %s - %s", url, resp.status_code)
             return {
                 "status": "success",
                 "status_code": resp.status_code,
                 "preview": resp.text[:500]
             }
         except Exception as e:
-            logger.error(f"Test request failed: {url} - {e}")
+            logger.error("Test request failed: %s - %s", url, e)
             return {"status": "error", "message": str(e)}
 
 
 def create_app():
     """Create and configure the main application"""
-    # Get the directory of the main script
-    app_dir = Path(__file__).parent
-    static_dir = app_dir / 'static'
+    static_dir = _APP_DIR / 'static'
     
     # Create static directory if it doesn't exist
     static_dir.mkdir(exist_ok=True)
     
-    # Load config
-    logger.info("加载配置文件...")
-    config_path = str(app_dir / 'config.json')
-    proxy_config = MITMProxyServer().load_config()
-    
-    # Initialize MITM proxy server (this will generate CA cert if needed)
+    # Initialize MITM proxy server (this loads config and generates CA cert if needed)
     logger.info("初始化MITM代理服务器...")
-    proxy_server = MITMProxyServer(
-        host='127.0.0.1',
-        port=proxy_config.get('port', 8080)
-    )
+    config_path = str(_APP_DIR / 'config.json')
+    proxy_server = MITMProxyServer(host='127.0.0.1')
+    proxy_config = proxy_server.config
+    proxy_server.port = proxy_config.get('port', 8080)
     
-    logger.info(f"代理服务器初始化完成，端口 {proxy_server.port}")
-    ca_cert_path = app_dir / '.certs' / 'ca-cert.pem'
-    logger.info(f"CA证书路径: {ca_cert_path}")
-    logger.info(f"CA证书{'已' if ca_cert_path.exists() else '未'}生成")
+    logger.info("代理服务器初始化完成，端口 %s", proxy_server.port)
+    # CertManager has already loaded or generated the CA at this point
+    logger.info("CA证书路径: %s", proxy_server.cert_manager.ca_cert_file.resolve())
     
     # Create HTML file if it doesn't exist
     html_file = static_dir / 'index.html'
     if not html_file.exists():
         logger.warning("index.html not found in static directory")
-        # Create a simple fallback HTML
-        html_file.write_text("""
-        <!DOCTYPE html>
-        <html>
-        <head>
-            <title>代理管理系统</title>
-            <style>
-                body { font-family: Arial; padding: 20px; background: #f5f5f5; }
-                .container { max-width: 1000px; margin: 0 auto; background: white; padding: 20px; border-radius: 10px; }
-                h1 { color: #667eea; }
-                button { background: #667eea; color: white; padding: 10px 20px; border: none; border-radius: 5px; cursor: pointer; }
-                input { padding: 8px; border: 1px solid #ddd; border-radius: 5px; }
-            </style>
-        </head>
-        <body>
-            <div class="container">
-                <h1>HTTP/HTTPS 代理管理系统</h1>
-                <p>代理管理系统已启动，正在加载界面...</p>
-            </div>
-        </body>
-        </html>
-        """)
+        # Write a simple fallback HTML
+        html_file.write_bytes(_FALLBACK_HTML)
     
     # Create API
-    api = AppAPI(config_path, proxy_config)
+    api = AppAPI(config_path, proxy_config, proxy_server.apply_config)
+    
+    # Set once the webview has loaded, so the proxy starts after the UI
+    ready = threading.Event()
+    if not WEBVIEW_AVAILABLE:
+        ready.set()
     
     # Start proxy server in a separate thread
     def run_proxy():
-        time.sleep(2)  # Wait for webview to initialize
+        ready.wait(timeout=5.0)  # Wait for webview to initialize
         logger.info("Starting proxy server...")
         proxy_server.run()
     
@@ -264,7 +379,7 @@ def create_app():
     
     # Create webview
     logger.info("Creating WebView window...")
-    webview.create_window(
+    window = webview.create_window(
         title='HTTP/HTTPS MITM代理管理系统',
         url=str(html_file),
         width=1200,
@@ -272,6 +387,7 @@ def create_app():
         min_size=(800, 600),
         js_api=api
     )
+    window.events.loaded += ready.set
     
     logger.info("Starting WebView...")
     # Start webview
@@ -288,6 +404,6 @@ if __name__ == '__main__':
         logger.info("\n应用已关闭")
         sys.exit(0)
     except Exception as e:
-        logger.error(f"错误: {e}", exc_info=True)
+        logger.error("错误: %s", e, exc_info=True)
         sys.exit(1)
 
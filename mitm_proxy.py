@@ -2,20 +2,33 @@
 支持SSL中间人拦截的HTTP/HTTPS代理服务器
 可以劫持HTTPS连接并重新签名证书
 """
+import copy
+import os
+import re
 import socket
 import ssl
 import threading
+import time
 import logging
-import select
-from urllib.parse import urlparse
+import selectors
+import queue
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
 import json
 from pathlib import Path
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 from cryptography import x509
 from cryptography.x509.oid import NameOID
 from cryptography.hazmat.primitives import hashes, serialization
 from cryptography.hazmat.backends import default_backend
-from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.hazmat.primitives.asymmetric import ec, rsa
+
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
 
 logging.basicConfig(
     level=logging.INFO,
@@ -23,42 +36,135 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# 监听队列长度，内核会按 somaxconn 截断
+LISTEN_BACKLOG = 4096
+# 隧道转发单次读取大小
+RELAY_BUFFER_SIZE = 65536
+# 上游域名解析结果缓存时间（秒）
+DNS_CACHE_TTL = 60.0
+# 域名映射查询结果缓存的最大条目数，超过后整体清空
+TARGET_CACHE_SIZE = 4096
+# 域名解析结果缓存的最大条目数，超过后整体清空
+DNS_CACHE_SIZE = 4096
+# 最多缓存的域名证书数量（按分片均分），超出时淘汰最久未用的
+CERT_CACHE_SIZE = 1024
+# 转发连接两端都没有数据超过该时间（秒）就断开，释放工作线程
+RELAY_IDLE_TIMEOUT = 300.0
+# 连接上游失败时返回给客户端的响应
+_BAD_GATEWAY = b'HTTP/1.1 502 Bad Gateway\r\n\r\n'
+# 工作线程全部占用时返回给客户端的响应
+_SERVICE_UNAVAILABLE = b'HTTP/1.1 503 Service Unavailable\r\nConnection: close\r\n\r\n'
+# Linux (Python 3.10+) 支持splice，明文TCP隧道可在内核中直接转发
+_HAS_SPLICE = hasattr(os, 'splice')
+
+# 域名中不能用于文件名的字符
+_UNSAFE_FILENAME_RE = re.compile(r'[^A-Za-z0-9.-]')
+# 在原始请求头字节中查找Host头，避免整体解码和逐行lower()
+_HOST_RE = re.compile(rb'\r\nHost:[ \t]*([^\r\n]*)', re.IGNORECASE)
+
+_CONFIG_PATH = Path(__file__).parent / 'config.json'
+# 配置文件不存在时使用的默认配置，使用时深拷贝，避免规则修改污染模板
+_DEFAULT_CONFIG = {"proxy_rules": {}, "port": 8080}
+
+# 证书有效期，起点回拨以容忍客户端时钟偏差
+_CA_VALIDITY = timedelta(days=3650)
+_LEAF_VALIDITY = timedelta(days=365)
+_CLOCK_SKEW = timedelta(minutes=1)
+
+# 域名证书主体中与域名无关的部分
+_LEAF_SUBJECT_PREFIX = (
+    x509.NameAttribute(NameOID.COUNTRY_NAME, "CN"),
+    x509.NameAttribute(NameOID.ORGANIZATION_NAME, "AIProxy"),
+)
+
 
 class CertManager:
     """证书管理器"""
     
-    def __init__(self, cert_dir: str = ".certs"):
+    def __init__(self, cert_dir: str = ".certs", key_type: str = "ec"):
         self.cert_dir = Path(cert_dir)
+        self.key_type = key_type
         self.cert_dir.mkdir(exist_ok=True)
         self.ca_cert_file = self.cert_dir / "ca-cert.pem"
         self.ca_key_file = self.cert_dir / "ca-key.pem"
         self._load_or_generate_ca()
+        
+        # 所有域名证书共用一把私钥，持久化后重启也无需重新生成
+        self.leaf_key_file = self.cert_dir / "leaf-key.pem"
+        self._load_or_generate_leaf_key()
+        # 域名证书的公共部分只构建一次，签发时只需补上主体、序列号、有效期和SAN
+        self._leaf_builder = (
+            x509.CertificateBuilder()
+            .issuer_name(self.ca_cert.subject)
+            .public_key(self._leaf_key.public_key())
+            .add_extension(
+                x509.BasicConstraints(ca=False, path_length=None),
+                critical=True,
+            )
+        )
+        # 按域名(SNI)缓存已签发的证书和SSL上下文，分片加锁、各自LRU淘汰；每个分片另记正在签发的域名
+        cpu_count = os.cpu_count() or 1
+        shard_count = 1
+        while shard_count < 2 * cpu_count:
+            shard_count <<= 1
+        self._shard_mask = shard_count - 1
+        self._shard_size = max(1, CERT_CACHE_SIZE // shard_count)
+        self._shards = [(threading.Lock(), OrderedDict(), {}) for _ in range(shard_count)]
+        # 签发是CPU密集型任务，放到独立的线程池，避免占住转发连接的I/O线程
+        self._crypto_pool = ThreadPoolExecutor(max_workers=cpu_count, thread_name_prefix='cert-sign')
     
     def _load_or_generate_ca(self):
         """加载或生成CA证书"""
-        if self.ca_cert_file.exists() and self.ca_key_file.exists():
-            with open(self.ca_key_file, 'rb') as f:
-                self.ca_key = serialization.load_pem_private_key(
-                    f.read(), password=None, backend=default_backend()
-                )
-            with open(self.ca_cert_file, 'rb') as f:
-                self.ca_cert = x509.load_pem_x509_certificate(
-                    f.read(), backend=default_backend()
-                )
-            logger.info("CA证书已加载")
-        else:
+        try:
+            ca_key_pem = self.ca_key_file.read_bytes()
+            ca_cert_pem = self.ca_cert_file.read_bytes()
+        except FileNotFoundError:
             self._generate_ca()
+            return
+        self.ca_key = serialization.load_pem_private_key(
+            ca_key_pem, password=None, backend=default_backend()
+        )
+        self.ca_cert = x509.load_pem_x509_certificate(
+            ca_cert_pem, backend=default_backend()
+        )
+        logger.info("CA证书已加载")
+    
+    def _load_or_generate_leaf_key(self):
+        """加载或生成域名证书共用的私钥，类型与key_type不符时重新生成"""
+        try:
+            self._leaf_key_pem = self.leaf_key_file.read_bytes()
+            self._leaf_key = serialization.load_pem_private_key(
+                self._leaf_key_pem, password=None, backend=default_backend()
+            )
+            is_rsa = isinstance(self._leaf_key, rsa.RSAPrivateKey)
+            if is_rsa == (self.key_type == "rsa"):
+                return
+        except (FileNotFoundError, ValueError):
+            pass
+        self._leaf_key = self._generate_private_key()
+        self._leaf_key_pem = self._leaf_key.private_bytes(
+            encoding=serialization.Encoding.PEM,
+            format=serialization.PrivateFormat.PKCS8,
+            encryption_algorithm=serialization.NoEncryption()
+        )
+        self.leaf_key_file.write_bytes(self._leaf_key_pem)
+    
+    def _generate_private_key(self):
+        """生成私钥，默认ECDSA P-256，key_type为rsa时使用RSA-2048"""
+        if self.key_type == "rsa":
+            return rsa.generate_private_key(
+                public_exponent=65537,
+                key_size=2048,
+                backend=default_backend()
+            )
+        return ec.generate_private_key(ec.SECP256R1(), default_backend())
     
     def _generate_ca(self):
         """生成CA证书"""
         logger.info("生成CA证书...")
         
         # 生成私钥
-        private_key = rsa.generate_private_key(
-            public_exponent=65537,
-            key_size=2048,
-            backend=default_backend()
-        )
+        private_key = self._generate_private_key()
         
         # 创建证书主体
         subject = issuer = x509.Name([
@@ -70,14 +176,15 @@ class CertManager:
         ])
         
         # 创建CA证书
+        now = datetime.now(timezone.utc)
         cert = (
             x509.CertificateBuilder()
             .subject_name(subject)
             .issuer_name(issuer)
             .public_key(private_key.public_key())
             .serial_number(x509.random_serial_number())
-            .not_valid_before(datetime.utcnow())
-            .not_valid_after(datetime.utcnow() + timedelta(days=3650))
+            .not_valid_before(now - _CLOCK_SKEW)
+            .not_valid_after(now + _CA_VALIDITY)
             .add_extension(
                 x509.BasicConstraints(ca=True, path_length=None),
                 critical=True,
@@ -99,37 +206,85 @@ class CertManager:
             .sign(private_key, hashes.SHA256(), default_backend())
         )
         
-        # 保存证书和私钥
-        with open(self.ca_key_file, "wb") as f:
-            f.write(private_key.private_bytes(
-                encoding=serialization.Encoding.PEM,
-                format=serialization.PrivateFormat.TraditionalOpenSSL,
-                encryption_algorithm=serialization.NoEncryption()
-            ))
-        
-        with open(self.ca_cert_file, "wb") as f:
-            f.write(cert.public_bytes(serialization.Encoding.PEM))
+        # 先序列化再一次性写入证书和私钥
+        ca_key_pem = private_key.private_bytes(
+            encoding=serialization.Encoding.PEM,
+            format=serialization.PrivateFormat.PKCS8,
+            encryption_algorithm=serialization.NoEncryption()
+        )
+        ca_cert_pem = cert.public_bytes(serialization.Encoding.PEM)
+        self.ca_key_file.write_bytes(ca_key_pem)
+        self.ca_cert_file.write_bytes(ca_cert_pem)
         
         self.ca_key = private_key
         self.ca_cert = cert
-        logger.info(f"CA证书已生成: {self.ca_cert_file}")
+        logger.info("CA证书已生成: %s", self.ca_cert_file)
         logger.info("请在浏览器中导入CA证书: .certs/ca-cert.pem")
     
+    def _get_entry(self, domain: str):
+        """获取域名的 (cert_pem, key_pem, ssl_context)，未签发过时交给签发线程池并等待结果"""
+        lock, cache, pending = self._shards[hash(domain) & self._shard_mask]
+        with lock:
+            entry = cache.get(domain)
+            if entry is not None:
+                cache.move_to_end(domain)
+                return entry
+            # 同一域名并发首次访问时只签发一次，其余请求等待同一个Future
+            future = pending.get(domain)
+            if future is None:
+                future = pending[domain] = self._crypto_pool.submit(self._issue_entry, domain)
+        return future.result()
+    
+    def _issue_entry(self, domain: str):
+        """签发证书并创建SSL上下文（在签发线程池中运行），完成后写入缓存"""
+        lock, cache, pending = self._shards[hash(domain) & self._shard_mask]
+        try:
+            cert_pem, key_pem = self._sign_for_host(domain)
+            ssl_context = self._build_server_context(domain, cert_pem)
+            entry = (cert_pem, key_pem, ssl_context)
+            with lock:
+                cache[domain] = entry
+                while len(cache) > self._shard_size:
+                    # 持锁删除证书文件，同一域名重新签发时要先拿到这把锁，不会删掉新写的文件
+                    evicted, _ = cache.popitem(last=False)
+                    self._host_cert_file(evicted).unlink(missing_ok=True)
+            return entry
+        finally:
+            # 签发失败时也要移除，下次访问可以重试
+            with lock:
+                pending.pop(domain, None)
+    
     def generate_cert_for_domain(self, domain: str):
-        """为指定域名生成证书"""
-        logger.info(f"为域名 {domain} 生成证书...")
-        
-        # 生成私钥
-        private_key = rsa.generate_private_key(
-            public_exponent=65537,
-            key_size=2048,
-            backend=default_backend()
-        )
+        """为指定域名获取证书，已签发过的域名直接返回缓存"""
+        cert_pem, key_pem, _ = self._get_entry(domain)
+        return cert_pem, key_pem
+    
+    def get_context_for_domain(self, domain: str):
+        """获取用于向客户端冒充该域名的服务端SSL上下文"""
+        return self._get_entry(domain)[2]
+    
+    def _host_cert_file(self, domain: str):
+        """域名证书的落盘路径"""
+        return self.cert_dir / f"host_{_UNSAFE_FILENAME_RE.sub('_', domain)}.crt"
+    
+    def _build_server_context(self, domain: str, cert_pem: bytes):
+        """用证书创建服务端SSL上下文，load_cert_chain只接受文件，证书按域名落盘一次，私钥共用leaf-key.pem"""
+        cert_file = self._host_cert_file(domain)
+        cert_file.write_bytes(cert_pem)
+        ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        # 只保留TLS 1.2+的ECDHE+AEAD套件；上下文按域名缓存，其会话缓存可让客户端重连时复用会话
+        ssl_context.minimum_version = ssl.TLSVersion.TLSv1_2
+        ssl_context.set_ciphers('ECDHE+AESGCM:ECDHE+CHACHA20')
+        ssl_context.load_cert_chain(str(cert_file), str(self.leaf_key_file))
+        return ssl_context
+    
+    def _sign_for_host(self, domain: str):
+        """用CA为指定域名签发证书"""
+        logger.info("为域名 %s 生成证书...", domain)
         
         # 创建证书主体
         subject = x509.Name([
-            x509.NameAttribute(NameOID.COUNTRY_NAME, "CN"),
-            x509.NameAttribute(NameOID.ORGANIZATION_NAME, "AIProxy"),
+            *_LEAF_SUBJECT_PREFIX,
             x509.NameAttribute(NameOID.COMMON_NAME, domain),
         ])
         
@@ -141,86 +296,165 @@ class CertManager:
             san_list.append(x509.DNSName(wildcard))
         
         # 创建证书
+        now = datetime.now(timezone.utc)
         cert = (
-            x509.CertificateBuilder()
+            self._leaf_builder
             .subject_name(subject)
-            .issuer_name(self.ca_cert.subject)
-            .public_key(private_key.public_key())
             .serial_number(x509.random_serial_number())
-            .not_valid_before(datetime.utcnow())
-            .not_valid_after(datetime.utcnow() + timedelta(days=365))
+            .not_valid_before(now - _CLOCK_SKEW)
+            .not_valid_after(now + _LEAF_VALIDITY)
             .add_extension(
                 x509.SubjectAlternativeName(san_list),
                 critical=False,
             )
-            .add_extension(
-                x509.BasicConstraints(ca=False, path_length=None),
-                critical=True,
-            )
             .sign(self.ca_key, hashes.SHA256(), default_backend())
         )
         
         # 返回证书和私钥
         cert_pem = cert.public_bytes(serialization.Encoding.PEM)
-        key_pem = private_key.private_bytes(
-            encoding=serialization.Encoding.PEM,
-            format=serialization.PrivateFormat.TraditionalOpenSSL,
-            encryption_algorithm=serialization.NoEncryption()
-        )
-        
-        return cert_pem, key_pem
+        return cert_pem, self._leaf_key_pem
 
 
 class MITMProxyServer:
-    def __init__(self, host='127.0.0.1', port=8080):
+    def __init__(self, host='127.0.0.1', port=8080, max_workers=256):
         self.host = host
         self.port = port
+        # 连接处理线程池：按需创建，最多max_workers个，空闲的CONNECT隧道也会占用一个线程
+        self.max_workers = max_workers
+        self._conn_queue = queue.Queue()
+        self._idle_workers = threading.Semaphore(0)
+        self._worker_count = 0
+        # (host, port) -> (过期时间, getaddrinfo结果)
+        self._dns_cache = {}
+        # 连接上游服务器用的SSL上下文，只创建一次（避免每次加载系统CA证书）
+        self._upstream_ssl_context = ssl.create_default_context()
+        self._upstream_ssl_context.check_hostname = False
+        self._upstream_ssl_context.verify_mode = ssl.CERT_NONE
+        # 解密后按原始字节转发，只能协商HTTP/1.1
+        self._upstream_ssl_context.set_alpn_protocols(['http/1.1'])
         self.config = self.load_config()
-        self.cert_manager = CertManager()
+        self._build_rule_index()
+        self.cert_manager = CertManager(
+            key_type=self.config.get('https', {}).get('key_type', 'ec')
+        )
     
     def load_config(self):
         """加载配置"""
-        config_path = Path(__file__).parent / 'config.json'
-        if config_path.exists():
-            with open(config_path, 'r', encoding='utf-8') as f:
+        try:
+            if ORJSON_AVAILABLE:
+                return orjson.loads(_CONFIG_PATH.read_bytes())
+            with open(_CONFIG_PATH, 'r', encoding='utf-8') as f:
                 return json.load(f)
-        return {"proxy_rules": {}, "port": 8080}
+        except FileNotFoundError:
+            return copy.deepcopy(_DEFAULT_CONFIG)
+    
+    @staticmethod
+    def _normalize_domain(value):
+        """去掉协议前缀和末尾的/，统一小写"""
+        return value.rpartition('://')[2].rstrip('/').lower()
+    
+    def apply_config(self, config):
+        """使用新的配置（如界面修改了映射规则），重建规则索引"""
+        self.config = config
+        self._build_rule_index()
+    
+    def _build_rule_index(self):
+        """预处理映射规则：规范化域名，建立精确匹配表和父域名表
+
+        普通规则同时匹配域名本身及其子域名；"*.a.com" 形式的通配符规则只匹配子域名
+        """
+        exact_rules = {}
+        suffix_rules = {}
+        for key, value in self.config.get('proxy_rules', {}).items():
+            key_domain = self._normalize_domain(key)
+            target = self._normalize_domain(value)
+            if key_domain.startswith('*.'):
+                key_domain = key_domain[2:]
+            else:
+                exact_rules.setdefault(key_domain, target)
+            suffix_rules.setdefault(key_domain, target)
+        # 两张表和对应的(空)查询结果缓存一次性替换，查询时整体读取，不会混用新旧规则
+        self._rule_index = (exact_rules, suffix_rules, {})
     
     def get_target_domain(self, original_domain):
-        """获取映射的目标域名"""
-        rules = self.config.get('proxy_rules', {})
-        domain = original_domain.split(':')[0]
-        if '://' in domain:
-            domain = domain.split('://')[1]
+        """获取映射的目标域名，按原始输入缓存结果"""
+        exact_rules, suffix_rules, target_cache = self._rule_index
+        target = target_cache.get(original_domain)
+        if target is None:
+            if len(target_cache) >= TARGET_CACHE_SIZE:
+                target_cache.clear()
+            target = target_cache[original_domain] = self._resolve_target_domain(
+                original_domain, exact_rules, suffix_rules
+            )
+        return target
+    
+    def _resolve_target_domain(self, original_domain, exact_rules, suffix_rules):
+        """按精确匹配、后缀匹配的顺序查找映射的目标域名，没有匹配时原样返回去掉端口的域名"""
+        host = original_domain.rpartition('://')[2].partition(':')[0]
+        domain = host.lower()
         
-        for key, value in rules.items():
-            key_domain = key.split('://')[-1] if '://' in key else key
-            if domain == key_domain or domain.endswith(key_domain):
-                target = value.split('://')[-1] if '://' in value else value
-                logger.info(f"域名映射: {domain} -> {target}")
-                return target
+        target = exact_rules.get(domain)
+        # 逐级去掉最左边的标签查父域名表，先命中的最具体，耗时与规则数量无关
+        parent = domain
+        while target is None:
+            dot = parent.find('.')
+            if dot < 0:
+                return host
+            parent = parent[dot + 1:]
+            target = suffix_rules.get(parent)
+        logger.info("域名映射: %s -> %s", domain, target)
+        return target
+    
+    def _connect_upstream(self, host, port):
+        """连接上游服务器，域名解析结果缓存DNS_CACHE_TTL秒"""
+        key = (host, port)
+        now = time.monotonic()
+        cached = self._dns_cache.get(key)
+        if cached is not None and cached[0] > now:
+            addresses = cached[1]
+        else:
+            addresses = socket.getaddrinfo(host, port, socket.AF_INET, socket.SOCK_STREAM)
+            if len(self._dns_cache) >= DNS_CACHE_SIZE:
+                self._dns_cache.clear()
+            self._dns_cache[key] = (now + DNS_CACHE_TTL, addresses)
         
-        return domain
+        last_error = None
+        for family, sock_type, proto, _, address in addresses:
+            target_socket = socket.socket(family, sock_type, proto)
+            target_socket.settimeout(10)
+            try:
+                target_socket.connect(address)
+                return target_socket
+            except OSError as e:
+                target_socket.close()
+                last_error = e
+        # 缓存的地址都连不上时下次重新解析
+        self._dns_cache.pop(key, None)
+        raise last_error
     
     def handle_request(self, client_socket):
         """处理客户端请求"""
         try:
-            request_data = b''
+            # 读取到请求头结束，只在新数据附近查找 \r\n\r\n
+            request_data = bytearray()
+            search_from = 0
             while True:
                 chunk = client_socket.recv(4096)
                 if not chunk:
                     break
-                request_data += chunk
-                if b'\r\n\r\n' in request_data:
+                request_data.extend(chunk)
+                if request_data.find(b'\r\n\r\n', search_from) >= 0:
                     break
+                search_from = max(0, len(request_data) - 3)
             
-            request_str = request_data.decode('utf-8', errors='ignore')
-            lines = request_str.split('\r\n')
-            
-            if not lines:
-                return
-            
-            first_line = lines[0]
+            # 只解码请求行
+            header_end = request_data.find(b'\r\n\r\n')
+            if header_end < 0:
+                header_end = len(request_data)
+            line_end = request_data.find(b'\r\n', 0, header_end)
+            if line_end < 0:
+                line_end = header_end
+            first_line = request_data[:line_end].decode('utf-8', errors='ignore')
             parts = first_line.split(' ')
             
             if len(parts) < 2:
@@ -229,42 +463,57 @@ class MITMProxyServer:
             method = parts[0]
             url = parts[1]
             
-            logger.info(f"收到请求: {method} {url[:100]}")
+            logger.debug("收到请求: %s %s", method, url[:100])
             
             if method.upper() == 'CONNECT':
                 self.handle_connect(client_socket, url)
                 return
             
-            # HTTP请求处理
-            if '://' not in url:
-                host = None
-                for line in lines[1:]:
-                    if line.lower().startswith('host:'):
-                        host = line.split(':', 1)[1].strip()
-                        break
-                if host:
-                    url = f'http://{host}{url}'
-            
-            parsed = urlparse(url)
-            if not parsed.netloc:
+            # HTTP请求处理：只解析出主机和端口，不再拼接URL
+            if '://' in url:
+                parsed = urlsplit(url)
+            else:
+                match = _HOST_RE.search(request_data, line_end, header_end + 2)
+                if not match:
+                    return
+                parsed = urlsplit('//' + match.group(1).strip().decode('utf-8', errors='ignore'))
+            host = parsed.hostname
+            if not host:
                 return
+            try:
+                port = parsed.port or 80
+                target_host, target_port = self._split_target(self.get_target_domain(host), port)
+            except ValueError as e:
+                logger.error("请求端口无效: %s", e)
+                self._send_bad_gateway(client_socket)
+                return
+            if (target_host, target_port) != (host, port):
+                logger.info("应用域名映射: %s:%s -> %s:%s", host, port, target_host, target_port)
             
-            mapped_domain = self.get_target_domain(parsed.netloc)
-            if mapped_domain != parsed.netloc:
-                logger.info(f"应用域名映射: {parsed.netloc} -> {mapped_domain}")
-                parsed = parsed._replace(netloc=mapped_domain, scheme='http')
-                url = parsed.geturl()
-            
-            self.forward_http(client_socket, url, request_data)
+            self.forward_http(client_socket, target_host, target_port, request_data)
             
         except Exception as e:
-            logger.error(f"处理请求错误: {e}")
+            logger.error("处理请求错误: %s", e)
         finally:
             try:
                 client_socket.close()
             except:
                 pass
     
+    @staticmethod
+    def _send_bad_gateway(client_socket):
+        """向客户端返回502，客户端已断开时忽略"""
+        try:
+            client_socket.sendall(_BAD_GATEWAY)
+        except OSError:
+            pass
+    
+    @staticmethod
+    def _split_target(target, default_port):
+        """把映射目标拆成 (主机, 端口)，目标带端口时用目标端口，否则沿用原端口；端口无效时抛出ValueError"""
+        parsed = urlsplit('//' + target)
+        return parsed.hostname, parsed.port or default_port
+    
     def handle_connect(self, client_socket, target):
         """处理HTTPS CONNECT - MITM模式"""
         try:
@@ -274,57 +523,40 @@ class MITMProxyServer:
             else:
                 host = target
                 port = 443
+            # 域名不区分大小写，统一小写后再比较映射结果，证书缓存也按小写域名
+            host = host.lower()
             
             # 应用域名映射
             original_host = host
             mapped_host = self.get_target_domain(host)
             
             if mapped_host != host:
-                logger.info(f"CONNECT映射: {host}:{port} -> {mapped_host}:{port}")
-                host = mapped_host
+                target_host, target_port = self._split_target(mapped_host, port)
+                logger.info("CONNECT映射: %s:%s -> %s:%s", host, port, target_host, target_port)
                 # 对于域名映射，使用MITM模式
-                self.do_mitm(client_socket, original_host, host, port)
+                self.do_mitm(client_socket, original_host, target_host, target_port)
             else:
                 # 不需要映射，直接隧道
                 self.do_tunnel(client_socket, host, port)
             
         except Exception as e:
-            logger.error(f"CONNECT失败: {e}")
-            try:
-                error_response = b'HTTP/1.1 502 Bad Gateway\r\n\r\n'
-                client_socket.sendall(error_response)
-            except:
-                pass
+            logger.error("CONNECT失败: %s", e)
+            self._send_bad_gateway(client_socket)
     
     def do_mitm(self, client_socket, original_host, target_host, port):
         """MITM模式：拦截SSL连接并重新签名"""
-        cert_file = None
-        key_file = None
         try:
             # 连接到目标服务器
-            target_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            target_socket.settimeout(10)
-            target_socket.connect((target_host, port))
+            target_socket = self._connect_upstream(target_host, port)
             
             # 建立与目标服务器的SSL连接
-            context = ssl.create_default_context()
-            context.check_hostname = False
-            context.verify_mode = ssl.CERT_NONE
-            ssl_target = context.wrap_socket(target_socket, server_hostname=target_host)
-            logger.info(f"MITM: 已连接到目标服务器 {target_host}:{port}")
-            
-            # 为原始域名生成证书
-            cert_pem, key_pem = self.cert_manager.generate_cert_for_domain(original_host)
-            
-            # 将证书和私钥写入临时文件
-            cert_file = self.cert_manager.cert_dir / f"temp_{original_host.replace('.', '_')}.crt"
-            key_file = self.cert_manager.cert_dir / f"temp_{original_host.replace('.', '_')}.key"
-            cert_file.write_bytes(cert_pem)
-            key_file.write_bytes(key_pem)
+            ssl_target = self._upstream_ssl_context.wrap_socket(
+                target_socket, server_hostname=target_host
+            )
+            logger.info("MITM: 已连接到目标服务器 %s:%s", target_host, port)
             
-            # 创建SSL上下文，使用生成的证书
-            ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
-            ssl_context.load_cert_chain(str(cert_file), str(key_file))
+            # 获取原始域名的SSL上下文（证书按域名缓存）
+            ssl_context = self.cert_manager.get_context_for_domain(original_host)
             
             # 向客户端发送200响应
             response = b'HTTP/1.1 200 Connection Established\r\n\r\n'
@@ -332,81 +564,58 @@ class MITMProxyServer:
             
             # 升级客户端连接为SSL
             ssl_client = ssl_context.wrap_socket(client_socket, server_side=True)
-            logger.info(f"MITM: 已建立与客户端的SSL连接 ({original_host})")
+            logger.info("MITM: 已建立与客户端的SSL连接 (%s)", original_host)
             
             # 双向转发数据
             self.relay_data(ssl_client, ssl_target)
             
         except Exception as e:
-            logger.error(f"MITM失败: {e}")
-            try:
-                error_response = b'HTTP/1.1 502 Bad Gateway\r\n\r\n'
-                client_socket.sendall(error_response)
-            except:
-                pass
+            logger.error("MITM失败: %s", e)
+            self._send_bad_gateway(client_socket)
         finally:
             try:
                 target_socket.close()
             except:
                 pass
-            # 清理临时文件
-            try:
-                if cert_file and cert_file.exists():
-                    cert_file.unlink()
-                if key_file and key_file.exists():
-                    key_file.unlink()
-            except:
-                pass
     
     def do_tunnel(self, client_socket, host, port):
         """直接隧道模式"""
         try:
-            target_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            target_socket.settimeout(10)
-            target_socket.connect((host, port))
-            
-            if port == 443:
-                context = ssl.create_default_context()
-                context.check_hostname = False
-                context.verify_mode = ssl.CERT_NONE
-                target_socket = context.wrap_socket(target_socket, server_hostname=host)
+            target_socket = self._connect_upstream(host, port)
             
+            # 客户端与目标服务器端到端握手，代理只转发原始字节
             response = b'HTTP/1.1 200 Connection Established\r\n\r\n'
             client_socket.sendall(response)
-            logger.info(f"隧道建立: {host}:{port}")
+            logger.info("隧道建立: %s:%s", host, port)
             
-            self.relay_data(client_socket, target_socket)
+            if _HAS_SPLICE:
+                self.splice_relay(client_socket, target_socket)
+            else:
+                self.relay_data(client_socket, target_socket)
             
         except Exception as e:
-            logger.error(f"隧道失败: {e}")
-            try:
-                error_response = b'HTTP/1.1 502 Bad Gateway\r\n\r\n'
-                client_socket.sendall(error_response)
-            except:
-                pass
+            logger.error("隧道失败: %s", e)
+            self._send_bad_gateway(client_socket)
         finally:
             try:
                 target_socket.close()
             except:
                 pass
     
-    def forward_http(self, client_socket, url, original_request):
+    def forward_http(self, client_socket, host, port, original_request):
         """转发HTTP请求"""
         try:
-            parsed = urlparse(url)
-            target_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            target_socket.settimeout(10)
-            target_socket.connect((parsed.hostname, parsed.port or 80))
+            target_socket = self._connect_upstream(host, port)
             target_socket.sendall(original_request)
-            self.relay_data(client_socket, target_socket)
+            # 请求头已发出，剩下的请求体和响应都是明文字节，同隧道一样可在内核中转发
+            if _HAS_SPLICE:
+                self.splice_relay(client_socket, target_socket)
+            else:
+                self.relay_data(client_socket, target_socket)
             
         except Exception as e:
-            logger.error(f"转发HTTP请求失败: {e}")
-            try:
-                error_response = b'HTTP/1.1 502 Bad Gateway\r\n\r\n'
-                client_socket.sendall(error_response)
-            except:
-                pass
+            logger.error("转发HTTP请求失败: %s", e)
+            self._send_bad_gateway(client_socket)
         finally:
             try:
                 target_socket.close()
@@ -415,55 +624,149 @@ class MITMProxyServer:
     
     def relay_data(self, client_socket, target_socket):
         """双向转发数据"""
+        selector = selectors.DefaultSelector()
         try:
-            sockets = [client_socket, target_socket]
+            # 使用非阻塞读：SSL套接字可读时收到的可能只是会话票据等非应用数据，阻塞读会卡住整条隧道
+            client_socket.setblocking(False)
+            target_socket.setblocking(False)
+            selector.register(client_socket, selectors.EVENT_READ, target_socket)
+            selector.register(target_socket, selectors.EVENT_READ, client_socket)
             timeout = 10
             
+            # 握手时可能已经解密并缓存了数据，select感知不到，先转发掉
+            for sock, peer in ((client_socket, target_socket), (target_socket, client_socket)):
+                if isinstance(sock, ssl.SSLSocket) and sock.pending():
+                    if not self._forward(sock, peer, timeout):
+                        return
+            
             while True:
-                readable, _, exceptional = select.select(sockets, [], sockets, timeout)
-                
-                if exceptional:
-                    break
-                
-                if not readable:
-                    continue
-                
-                for sock in readable:
+                events = selector.select(RELAY_IDLE_TIMEOUT)
+                if not events:
+                    logger.debug("连接空闲超时，结束转发")
+                    return
+                for key, _ in events:
+                    if not self._forward(key.fileobj, key.data, timeout):
+                        return
+        except Exception as e:
+            logger.debug("数据转发结束: %s", e)
+        finally:
+            selector.close()
+    
+    def _forward(self, src, dst, timeout):
+        """把src当前可读的数据转发给dst，对端关闭时返回False"""
+        while True:
+            try:
+                data = src.recv(RELAY_BUFFER_SIZE)
+            except (ssl.SSLWantReadError, BlockingIOError):
+                return True
+            if not data:
+                return False
+            self._send_all(dst, data, timeout)
+            # SSL套接字内部可能还缓存着已解密的数据，需要继续读完
+            if not (isinstance(src, ssl.SSLSocket) and src.pending()):
+                return True
+    
+    def _send_all(self, sock, data, timeout):
+        """在非阻塞套接字上发送全部数据，发送缓冲区满时等待可写"""
+        view = memoryview(data)
+        while view:
+            try:
+                sent = sock.send(view)
+            except (ssl.SSLWantWriteError, ssl.SSLWantReadError, BlockingIOError):
+                with selectors.DefaultSelector() as waiter:
+                    waiter.register(sock, selectors.EVENT_WRITE)
+                    if not waiter.select(timeout):
+                        raise socket.timeout("发送超时")
+                continue
+            view = view[sent:]
+    
+    def splice_relay(self, client_socket, target_socket):
+        """双向转发明文TCP数据，经管道用splice在内核中搬运，不复制到用户态"""
+        selector = selectors.DefaultSelector()
+        pipe_fds = []
+        try:
+            client_socket.setblocking(False)
+            target_socket.setblocking(False)
+            for src, dst in ((client_socket, target_socket), (target_socket, client_socket)):
+                pipe_r, pipe_w = os.pipe()
+                pipe_fds += (pipe_r, pipe_w)
+                selector.register(src, selectors.EVENT_READ, (dst, pipe_r, pipe_w))
+            flags = os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK
+            timeout = 10
+            
+            while True:
+                events = selector.select(RELAY_IDLE_TIMEOUT)
+                if not events:
+                    logger.debug("连接空闲超时，结束转发")
+                    return
+                for key, _ in events:
+                    dst, pipe_r, pipe_w = key.data
                     try:
-                        data = sock.recv(4096)
-                        if not data:
-                            return
-                        if sock is client_socket:
-                            target_socket.sendall(data)
-                        else:
-                            client_socket.sendall(data)
-                    except:
+                        pending = os.splice(key.fd, pipe_w, RELAY_BUFFER_SIZE, flags=flags)
+                    except BlockingIOError:
+                        continue
+                    if not pending:
                         return
+                    # 每次都把管道排空，保证下次读取时管道有足够空间
+                    while pending:
+                        try:
+                            pending -= os.splice(pipe_r, dst.fileno(), pending, flags=flags)
+                        except BlockingIOError:
+                            with selectors.DefaultSelector() as waiter:
+                                waiter.register(dst, selectors.EVENT_WRITE)
+                                if not waiter.select(timeout):
+                                    raise socket.timeout("发送超时")
         except Exception as e:
-            logger.debug(f"数据转发结束: {e}")
+            logger.debug("数据转发结束: %s", e)
+        finally:
+            selector.close()
+            for fd in pipe_fds:
+                os.close(fd)
+    
+    def _submit(self, client_socket):
+        """把连接交给工作线程，没有空闲线程且未达上限时新建一个，已达上限时返回503"""
+        if not self._idle_workers.acquire(blocking=False):
+            if self._worker_count >= self.max_workers:
+                # 长连接会一直占住线程，排队可能无限期等待，直接拒绝
+                logger.warning("工作线程已满 (%s)，拒绝新连接", self.max_workers)
+                try:
+                    client_socket.sendall(_SERVICE_UNAVAILABLE)
+                except OSError:
+                    pass
+                client_socket.close()
+                return
+            self._worker_count += 1
+            threading.Thread(
+                target=self._worker,
+                name=f'mitm-conn-{self._worker_count}',
+                daemon=True
+            ).start()
+        self._conn_queue.put(client_socket)
+    
+    def _worker(self):
+        """工作线程循环处理排队的连接"""
+        while True:
+            client_socket = self._conn_queue.get()
+            self.handle_request(client_socket)
+            self._idle_workers.release()
     
     def run(self):
         """启动代理服务器"""
         server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         server_socket.bind((self.host, self.port))
-        server_socket.listen(5)
+        server_socket.listen(LISTEN_BACKLOG)
         
-        logger.info(f"MITM代理服务器启动: {self.host}:{self.port}")
+        logger.info("MITM代理服务器启动: %s:%s", self.host, self.port)
         logger.info("等待连接...")
         logger.info("重要: 请将 .certs/ca-cert.pem 导入浏览器受信任根证书颁发机构！")
         
         try:
             while True:
                 client_socket, client_address = server_socket.accept()
-                logger.info(f"新连接: {client_address}")
+                logger.debug("新连接: %s", client_address)
                 
-                thread = threading.Thread(
-                    target=self.handle_request,
-                    args=(client_socket,)
-                )
-                thread.daemon = True
-                thread.start()
+                self._submit(client_socket)
                 
         except KeyboardInterrupt:
             logger.info("服务器停止")
@@ -472,8 +775,6 @@ class MITMProxyServer:
 
 
 if __name__ == '__main__':
-    config = MITMProxyServer().load_config()
-    port = config.get('port', 8080)
-    
-    proxy = MITMProxyServer(port=port)
+    proxy = MITMProxyServer()
+    proxy.port = proxy.config.get('port', 8080)
     proxy.run()